@@ -1,4 +1,6 @@
+import functools
 import json
+import os
 
 import torch
 from parameterized import parameterized
@@ -7,51 +9,100 @@ from torchaudio.models.wav2vec2.utils import import_huggingface_model
 from torchaudio_unittest.common_utils import get_asset_path, skipIfNoModule, TorchaudioTestCase
 
 
+@functools.lru_cache(maxsize=None)
 def _load_config(*paths):
     with open(f'{get_asset_path("wav2vec2", "huggingface", *paths)}.json', "r") as file_:
         return json.load(file_)
 
 
+def _get_model(config):
+    # Helper function to avoid importing transformers on module scope.
+    # Normally, we use `is_module_available` helper function to check if
+    # the library is available, and import it on module scope if available.
+    # However, somehow, once "transformers" is imported, `is_module_available`
+    # starts to fail. Therefore, we defer importing "transformers" until
+    # the actual tests are started.
+    # The import statement runs once per test, and modules imported already
+    # are looked up from `sys.modules`, so this does not add a noticeable cost.
+    from transformers.models.wav2vec2 import Wav2Vec2Config, Wav2Vec2ForCTC, Wav2Vec2Model
+
+    if config["architectures"] == ["Wav2Vec2Model"]:
+        return Wav2Vec2Model(Wav2Vec2Config(**config))
+    if config["architectures"] == ["Wav2Vec2ForCTC"]:
+        return Wav2Vec2ForCTC(Wav2Vec2Config(**config))
+    raise ValueError(f'Unexpected arch: {config["architectures"]}')
+
+
+def _get_models(config):
+    original = _get_model(config).eval()
+    imported = import_huggingface_model(original).eval()
+    return original, imported
+
+
+def _forward_with_layer_outputs(encoder, layers, x):
+    # Run the encoder, capturing the outputs of the given layers with forward hooks.
+    layer_outputs = []
+    handles = [
+        layer.register_forward_hook(lambda _module, _input, output: layer_outputs.append(output)) for layer in layers
+    ]
+    try:
+        output = encoder(x)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return layer_outputs, output
+
+
 def _name_func(testcase_func, i, param):
-    return f"{testcase_func.__name__}_{i}_{param[0][1].__name__}"
-
-
-# Pretrained
-HF_BASE = _load_config("wav2vec2-base")
-HF_LARGE = _load_config("wav2vec2-large")
-HF_LARGE_LV60 = _load_config("wav2vec2-large-lv60")
-HF_LARGE_XLSR_53 = _load_config("wav2vec2-large-xlsr-53")
-HF_BASE_10K_VOXPOPULI = _load_config("wav2vec2-base-10k-voxpopuli")
-# Finetuned
-HF_BASE_960H = _load_config("wav2vec2-base-960h")
-HF_LARGE_960H = _load_config("wav2vec2-large-960h")
-HF_LARGE_LV60_960H = _load_config("wav2vec2-large-960h-lv60")
-HF_LARGE_LV60_SELF_960H = _load_config("wav2vec2-large-960h-lv60-self")
-HF_LARGE_XLSR_DE = _load_config("wav2vec2-large-xlsr-53-german")
-
-# Config and corresponding factory functions
+    return f"{testcase_func.__name__}_{i}_{parameterized.to_safe_name(param[0][0])}"
+
+
+# Config names and corresponding factory functions.
+# The configs are parsed only when the tests using them are run.
 PRETRAIN_CONFIGS = parameterized.expand(
     [
-        (HF_BASE, wav2vec2_base),
-        (HF_LARGE, wav2vec2_large),
-        (HF_LARGE_LV60, wav2vec2_large_lv60k),
-        (HF_LARGE_XLSR_53, wav2vec2_large_lv60k),
-        (HF_BASE_10K_VOXPOPULI, wav2vec2_base),
+        ("wav2vec2-base", wav2vec2_base),
+        ("wav2vec2-large", wav2vec2_large),
+        ("wav2vec2-large-lv60", wav2vec2_large_lv60k),
+        ("wav2vec2-large-xlsr-53", wav2vec2_large_lv60k),
+        ("wav2vec2-base-10k-voxpopuli", wav2vec2_base),
     ],
     name_func=_name_func,
 )
 FINETUNE_CONFIGS = parameterized.expand(
     [
-        (HF_BASE_960H, wav2vec2_base),
-        (HF_LARGE_960H, wav2vec2_large),
-        (HF_LARGE_LV60_960H, wav2vec2_large_lv60k),
-        (HF_LARGE_LV60_SELF_960H, wav2vec2_large_lv60k),
-        (HF_LARGE_XLSR_DE, wav2vec2_large_lv60k),
+        ("wav2vec2-base-960h", wav2vec2_base),
+        ("wav2vec2-large-960h", wav2vec2_large),
+        ("wav2vec2-large-960h-lv60", wav2vec2_large_lv60k),
+        ("wav2vec2-large-960h-lv60-self", wav2vec2_large_lv60k),
+        ("wav2vec2-large-xlsr-53-german", wav2vec2_large_lv60k),
     ],
     name_func=_name_func,
 )
 
 
+_NUM_THREADS = None
+
+
+def setUpModule():
+    # pytest-xdist runs the tests in multiple worker processes, and the default intra-op
+    # parallelism of each worker uses all the CPUs, which oversubscribes them.
+    # The intra-op threads are split among the workers, so that e.g. with `pytest -n auto`,
+    # which runs one worker per CPU, each worker uses one thread.
+    # Note: `torch.set_num_interop_threads` is not used, because it raises an error once
+    # inter-op parallel work has started, which other test modules in the worker might have done.
+    global _NUM_THREADS
+    num_workers = int(os.environ.get("PYTEST_XDIST_WORKER_COUNT", "1"))
+    if num_workers > 1:
+        _NUM_THREADS = torch.get_num_threads()
+        torch.set_num_threads(max(1, _NUM_THREADS // num_workers))
+
+
+def tearDownModule():
+    if _NUM_THREADS is not None:
+        torch.set_num_threads(_NUM_THREADS)
+
+
 @skipIfNoModule("transformers")
 class TestHFIntegration(TorchaudioTestCase):
     """Test the process of importing the models from Hugging Face Transformers
@@ -61,163 +112,160 @@ class TestHFIntegration(TorchaudioTestCase):
     2. The same model can be recreated without Hugging Face Transformers.
     """
 
-    def _get_model(self, config):
-        # Helper function to avoid importing transformers on module scope.
-        # Normally, we use `is_module_available` helper function to check if
-        # the library is available, and import it on module scope if available.
-        # However, somehow, once "transformers" is imported, `is_module_available`
-        # starts to fail. Therefore, we defer importing "transformers" until
-        # the actual tests are started.
-        from transformers.models.wav2vec2 import Wav2Vec2Config, Wav2Vec2ForCTC, Wav2Vec2Model
-
-        if config["architectures"] == ["Wav2Vec2Model"]:
-            return Wav2Vec2Model(Wav2Vec2Config(**config))
-        if config["architectures"] == ["Wav2Vec2ForCTC"]:
-            return Wav2Vec2ForCTC(Wav2Vec2Config(**config))
-        raise ValueError(f'Unexpected arch: {config["architectures"]}')
-
-    def _test_import_pretrain(self, original, imported, config):
-        # FeatureExtractor
-        x = torch.randn(3, 1024)
-        ref = original.feature_extractor(x).transpose(1, 2)
-        hyp, _ = imported.feature_extractor(x, None)
-        self.assertEqual(ref, hyp)
-        # Feature projection
-        x = torch.randn(3, 10, config["conv_dim"][-1])
-        ref = original.feature_projection(x)[0]
-        hyp = imported.encoder.feature_projection(x)
-        self.assertEqual(ref, hyp)
-        # Convolutional Positional Encoder
-        x = torch.randn(3, 256, config["hidden_size"])
-        ref = original.encoder.pos_conv_embed(x)
-        hyp = imported.encoder.transformer.pos_conv_embed(x)
-        self.assertEqual(ref, hyp)
-        # Encoder Transformer Layer
-        for original_, imported_ in zip(original.encoder.layers, imported.encoder.transformer.layers):
-            b, l, e = 16, 3, config["hidden_size"]
-            x = torch.randn(b, l, e)
-            mask = torch.randn(b, 1, l, l)
-
-            (ref,) = original_(x, attention_mask=mask, output_attentions=False)
-            hyp = imported_(x, mask)
-            self.assertEqual(ref, hyp)
-        # The whole Encoder Transformer
-        b, l, e = 16, 3, config["hidden_size"]
-        x = torch.randn(b, l, e)
-        ref = original.encoder(x).last_hidden_state
-        hyp = imported.encoder.transformer(x)
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Inputs are generated once and shared by all the tests.
+        # For all the configs, `conv_dim[-1]` is 512 and `hidden_size` is either 768 or 1024.
+        generator = torch.Generator().manual_seed(0)
+        cls.waveforms = torch.randn(3, 1024, generator=generator)
+        # Lengths are fixed, so that the samples are actually padded, including a short one.
+        cls.lengths = torch.tensor([1024, 600, 300])
+        cls.attention_mask = torch.arange(1024).expand(3, 1024) < cls.lengths[:, None]
+        cls.features = {dim: torch.randn(3, 10, dim, generator=generator) for dim in (512, 768, 1024)}
+        cls.sequences = {dim: torch.randn(3, 256, dim, generator=generator) for dim in (768, 1024)}
+        cls.layer_inputs = {dim: torch.randn(16, 3, dim, generator=generator) for dim in (768, 1024)}
+        cls.layer_mask = torch.randn(16, 1, 3, 3, generator=generator)
+
+    def _assert_equal(self, ref, hyp):
+        # Correctly imported models often produce bit-identical outputs,
+        # in which case the tolerance-based comparison can be skipped.
+        if ref.shape == hyp.shape and ref.dtype == hyp.dtype and torch.equal(ref, hyp):
+            return
         self.assertEqual(ref, hyp)
 
-    def _test_import_finetune(self, original, imported, config):
+    @torch.inference_mode()
+    def _compute_outputs(self, model, config):
+        """Run the components of torchaudio's wav2vec2 model on the shared inputs"""
+        transformer = model.encoder.transformer
+        x = self.layer_inputs[config["hidden_size"]]
+        layer_outputs, transformer_output = _forward_with_layer_outputs(transformer, transformer.layers, x)
+        outputs = {
+            "feature_extractor": model.feature_extractor(self.waveforms, None)[0],
+            "feature_projection": model.encoder.feature_projection(self.features[config["conv_dim"][-1]]),
+            "pos_conv_embed": transformer.pos_conv_embed(self.sequences[config["hidden_size"]]),
+            "layers": layer_outputs,
+            "layers_with_mask": [layer(x, self.layer_mask) for layer in transformer.layers],
+            "transformer": transformer_output,
+            "model": model(self.waveforms)[0],
+        }
+        if model.aux is not None:
+            outputs["aux"] = model.aux(self.features[config["hidden_size"]])
+        return outputs
+
+    @torch.inference_mode()
+    def _check_feature_extractor(self, original, hyps):
+        ref = original.feature_extractor(self.waveforms).transpose(1, 2)
+        self._assert_equal(ref, hyps["feature_extractor"])
+
+    @torch.inference_mode()
+    def _check_projection(self, original, hyps, config):
+        ref = original.feature_projection(self.features[config["conv_dim"][-1]])[0]
+        self._assert_equal(ref, hyps["feature_projection"])
+
+    @torch.inference_mode()
+    def _check_pos_conv_embed(self, original, hyps, config):
+        ref = original.encoder.pos_conv_embed(self.sequences[config["hidden_size"]])
+        self._assert_equal(ref, hyps["pos_conv_embed"])
+
+    @torch.inference_mode()
+    def _check_encoder_layers(self, original, hyps, config):
+        # All the layers are checked with a single pass of the encoder,
+        # which also checks the output of the whole Encoder Transformer.
+        x = self.layer_inputs[config["hidden_size"]]
+        layer_refs, ref = _forward_with_layer_outputs(original.encoder, original.encoder.layers, x)
+        self.assertEqual(len(layer_refs), len(hyps["layers"]))
+        for layer_ref, layer_hyp in zip(layer_refs, hyps["layers"]):
+            self._assert_equal(layer_ref[0], layer_hyp)
+        self._assert_equal(ref.last_hidden_state, hyps["transformer"])
+        # Each layer with attention mask
+        self.assertEqual(len(original.encoder.layers), len(hyps["layers_with_mask"]))
+        for layer, layer_hyp in zip(original.encoder.layers, hyps["layers_with_mask"]):
+            (layer_ref,) = layer(x, attention_mask=self.layer_mask, output_attentions=False)
+            self._assert_equal(layer_ref, layer_hyp)
+
+    @torch.inference_mode()
+    def _check_full_encoder(self, original, hyps, config):
+        ref = original.encoder(self.layer_inputs[config["hidden_size"]]).last_hidden_state
+        self._assert_equal(ref, hyps["transformer"])
+
+    def _test_import_pretrain(self, original, hyps, config):
+        self._check_feature_extractor(original, hyps)
+        self._check_projection(original, hyps, config)
+        self._check_pos_conv_embed(original, hyps, config)
+        self._check_encoder_layers(original, hyps, config)
+
+    @torch.inference_mode()
+    def _test_import_finetune(self, original, imported, hyps, config):
         # Aux
-        x = torch.randn(3, 10, config["hidden_size"])
-        ref = original.lm_head(x)
-        hyp = imported.aux(x)
-        self.assertEqual(ref, hyp)
+        ref = original.lm_head(self.features[config["hidden_size"]])
+        self._assert_equal(ref, hyps["aux"])
         # The whole model without mask
-        x = torch.randn(3, 1024)
-        ref = original(x).logits
-        hyp, _ = imported(x)
-        self.assertEqual(ref, hyp)
-        # The whole model without mask
-        batch_size, num_frames = 3, 1024
-        x = torch.randn(batch_size, num_frames)
-        ref = original(x).logits
-        hyp, _ = imported(x)
-        self.assertEqual(ref, hyp)
+        ref = original(self.waveforms).logits
+        self._assert_equal(ref, hyps["model"])
 
         # The whole model with mask
-        batch_size, num_frames = 3, 1024
-        x = torch.randn(batch_size, num_frames)
-        lengths = torch.randint(
-            low=0,
-            high=num_frames,
-            size=[
-                batch_size,
-            ],
-        )
-        mask = torch.arange(num_frames).expand(batch_size, num_frames) < lengths[:, None]
-
+        x, lengths, mask = self.waveforms, self.lengths, self.attention_mask
         ref = original(x, attention_mask=mask).logits
         hyp, output_lengths = imported(x, lengths)
+        # Make sure that some frames are masked, otherwise this is the same as the check without mask.
+        self.assertTrue((output_lengths < ref.size(1)).any())
 
-        for i, l in enumerate(output_lengths):
-            self.assertEqual(ref[i, :l, ...], hyp[i, :l, ...])
+        # Compare only the valid frames of all the samples at once
+        valid = torch.arange(ref.size(1))[None, :] < output_lengths[:, None]
+        self._assert_equal(ref[valid], hyp[valid])
 
-    @PRETRAIN_CONFIGS
-    def test_import_pretrain(self, config, _):
-        """wav2vec2 models from HF transformers can be imported and yields the same results"""
-        original = self._get_model(config).eval()
-        imported = import_huggingface_model(original).eval()
-        self._test_import_pretrain(original, imported, config)
-
-    @FINETUNE_CONFIGS
-    def test_import_finetune(self, config, _):
-        """wav2vec2 models from HF transformers can be imported and yields the same results"""
-        original = self._get_model(config).eval()
-        imported = import_huggingface_model(original).eval()
-        self._test_import_pretrain(original.wav2vec2, imported, config)
-        self._test_import_finetune(original, imported, config)
-
-    def _test_recreate(self, imported, reloaded, config):
-        # FeatureExtractor
-        x = torch.randn(3, 1024)
-        ref, _ = imported.feature_extractor(x, None)
-        hyp, _ = reloaded.feature_extractor(x, None)
-        self.assertEqual(ref, hyp)
-        # Feature projection
-        x = torch.randn(3, 10, config["conv_dim"][-1])
-        ref = imported.encoder.feature_projection(x)
-        hyp = reloaded.encoder.feature_projection(x)
-        self.assertEqual(ref, hyp)
-        # Convolutional Positional Encoder
-        x = torch.randn(3, 256, config["hidden_size"])
-        ref = imported.encoder.transformer.pos_conv_embed(x)
-        hyp = reloaded.encoder.transformer.pos_conv_embed(x)
-        self.assertEqual(ref, hyp)
-        # Encoder Transformer Layer
-        for imported_, reloaded_ in zip(imported.encoder.transformer.layers, reloaded.encoder.transformer.layers):
-            b, l, e = 16, 3, config["hidden_size"]
-            x = torch.randn(b, l, e)
-            mask = torch.randn(b, 1, l, l)
-
-            ref = imported_(x, mask)
-            hyp = reloaded_(x, mask)
-            self.assertEqual(ref, hyp)
-        # The whole Encoder Transformer
-        # TODO: Add mask pattern. Expected mask shapes and values are different.
-        b, l, e = 16, 3, config["hidden_size"]
-        x = torch.randn(b, l, e)
-        mask = torch.randn(b, 1, l, l)
-        ref = imported.encoder.transformer(x)
-        hyp = reloaded.encoder.transformer(x)
-        self.assertEqual(ref, hyp)
-        # Aux
-        if imported.aux is not None:
-            x = torch.randn(3, 10, config["hidden_size"])
-            ref = imported.aux(x)
-            hyp = reloaded.aux(x)
-            self.assertEqual(ref, hyp)
-        # The whole model
-        x = torch.randn(3, 1024)
-        ref, _ = imported(x)
-        hyp, _ = reloaded(x)
-        self.assertEqual(ref, hyp)
+    def _test_recreate(self, refs, reloaded, config):
+        # TODO: Add mask pattern to the whole Encoder Transformer.
+        # Expected mask shapes and values are different.
+        hyps = self._compute_outputs(reloaded, config)
+        self.assertEqual(refs.keys(), hyps.keys())
+        for key, ref in refs.items():
+            hyp = hyps[key]
+            if isinstance(ref, list):
+                self.assertEqual(len(ref), len(hyp))
+                for ref_, hyp_ in zip(ref, hyp):
+                    self._assert_equal(ref_, hyp_)
+            else:
+                self._assert_equal(ref, hyp)
 
+    # Constructing and importing the large models dominates the runtime of this test suite,
+    # so the import and recreate checks of a config are performed in the same test.
+    # This way, each model is built only once, and only the models of one config are alive at a time.
     @PRETRAIN_CONFIGS
-    def test_recreate_pretrain(self, config, factory_func):
-        """Imported models can be recreated via a factory function without Hugging Face transformers."""
-        imported = import_huggingface_model(self._get_model(config)).eval()
+    def test_import_and_recreate_pretrain(self, config_name, factory_func):
+        """wav2vec2 models from HF transformers can be imported and recreated without HF transformers"""
+        config = _load_config(config_name)
+        original, imported = _get_models(config)
+        # The outputs of the imported model are used both by the import checks
+        # and, as the reference, by the recreate checks.
+        imported_outputs = self._compute_outputs(imported, config)
+        self._test_import_pretrain(original, imported_outputs, config)
+        # The recreate checks do not use the HF model, so release it before building another model.
+        del original
+
         reloaded = factory_func()
         reloaded.load_state_dict(imported.state_dict())
         reloaded.eval()
-        self._test_recreate(imported, reloaded, config)
+        self._test_recreate(imported_outputs, reloaded, config)
 
     @FINETUNE_CONFIGS
-    def test_recreate_finetune(self, config, factory_func):
-        """Imported models can be recreated via a factory function without Hugging Face transformers."""
-        imported = import_huggingface_model(self._get_model(config)).eval()
+    def test_import_and_recreate_finetune(self, config_name, factory_func):
+        """wav2vec2 models from HF transformers can be imported and recreated without HF transformers"""
+        config = _load_config(config_name)
+        original, imported = _get_models(config)
+        # The outputs of the imported model are used both by the import checks
+        # and, as the reference, by the recreate checks.
+        imported_outputs = self._compute_outputs(imported, config)
+        # The components are covered by the pretrained models. Without mask, any divergence
+        # in them propagates to the output of the whole encoder, and masked attention is
+        # covered by the check of the whole model with mask in `_test_import_finetune`.
+        self._check_full_encoder(original.wav2vec2, imported_outputs, config)
+        self._test_import_finetune(original, imported, imported_outputs, config)
+        # The recreate checks do not use the HF model, so release it before building another model.
+        del original
+
         reloaded = factory_func(aux_num_out=imported.aux.out_features)
         reloaded.load_state_dict(imported.state_dict())
         reloaded.eval()
-        self._test_recreate(imported, reloaded, config)
+        self._test_recreate(imported_outputs, reloaded, config)